@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import socket
 import subprocess
+import hashlib
 import paho.mqtt.client as mqtt
 import time
 import os
 import re
 import json
+import orjson
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Native IPMI backend (preferred). Falls back to SMCIPMITool if missing.
+try:
+    from pyghmi.ipmi import command as ipmi_command
+except ImportError:
+    ipmi_command = None
 
 # --- Logging Setup ---
 # Configure basic logging format
@@ -24,9 +33,40 @@ IPMI_USER = os.environ.get("IPMI_USER", "ADMIN")
 IPMI_PASS = os.environ.get("IPMI_PASS", "PASSWORD")
 INTERVAL = int(os.environ.get("INTERVAL", 60))
 
-# SMCIPMITool command
+# SMCIPMITool command (interactive shell mode, so the JVM starts once
+# and 'pminfo' is sent per poll instead of fork/exec'ing a fresh JVM)
 SMCIPMI_CMD = ["java", "-jar", "/usr/local/bin/SMCIPMITool.jar"]
-SMCIPMI_PMINFO = [IPMI_HOST, IPMI_USER, IPMI_PASS, "pminfo"]
+SMCIPMI_SHELL = [IPMI_HOST, IPMI_USER, IPMI_PASS, "shell"]
+SMCIPMI_PROMPT = "> "
+
+# Precompiled patterns for parsing the 'pminfo' output, compiled once at
+# module load instead of on every poll.
+_MODULE_SPLIT = re.compile(r"\[Module\s*(\d+)\]")
+
+# Maps the parsed field name to its topic suffix and value converter
+_FIELD_MAP = {
+    'Status':        ('status', str),
+    'Input Voltage': ('volt', float),
+    'Input Current': ('amp', float),
+    'Input Power':   ('watts', float),
+}
+
+# Matches the PSU sensor names reported over native IPMI, e.g. "PS1 Input Power"
+_IPMI_SENSOR_RE = re.compile(r"PS(\d+)\s+(Status|Input Voltage|Input Current|Input Power)")
+
+# Cached pyghmi session, created lazily and reset on error
+_IPMI_CMD = None
+
+# Whether the native backend is still considered viable. Cleared at runtime
+# when the BMC exposes no PSU sensors over SDR (Supermicro PSU input data is
+# often PMBus/'pminfo'-only) or after repeated session errors, after which
+# polls go through SMCIPMITool instead.
+_PYGHMI_USABLE = ipmi_command is not None
+_PYGHMI_MAX_ERRORS = 3
+_PYGHMI_ERRORS = 0
+
+# Long-lived SMCIPMITool shell process (fallback backend)
+_SMC_PROC = None
 
 # --- Global Client and Connection Status ---
 MQTT_CLIENT = None
@@ -35,6 +75,9 @@ BASE_TOPIC = f"techthom/ipmi_{BASE_CLIENT_ID}"
 
 # --- Discovery Constants ---
 HA_DISCOVERY_PREFIX = "homeassistant"
+# Hash of the last published discovery config, used to skip re-publishing
+# the retained configs on every container restart
+DISCOVERY_HASH_FILE = "/app/data/discovery.hash"
 
 # --- Energy Counter Persistence ---
 ENERGY_FILE = "/app/data/energy_total.json"
@@ -42,8 +85,18 @@ ENERGY_FILE = "/app/data/energy_total.json"
 ENERGY_STATE = {
     "last_power_w": 0.0,
     "last_update_ts": time.time(),
-    "total_energy_kwh": 0.0
+    "total_energy_kwh": 0.0,
+    "last_saved_kwh": 0.0
 }
+# Persist only once this much energy has accumulated since the last save,
+# or the last save is older than this many seconds
+_SAVE_MIN_DELTA_KWH = 0.001
+_SAVE_MAX_AGE_SEC = 600
+_LAST_SAVE_MONO = time.monotonic()
+# Monotonic timestamp of the last energy update. Kept outside ENERGY_STATE
+# because a monotonic reading is meaningless across restarts and must not
+# be persisted.
+_LAST_MONOTONIC = time.monotonic()
 
 # --- Persistence Functions ---
 
@@ -60,12 +113,32 @@ def load_energy_state():
             pass # Use default initial state
     else:
         logger.info("No existing energy state file found. Starting from 0 kWh.")
+    ENERGY_STATE["last_saved_kwh"] = ENERGY_STATE["total_energy_kwh"]
+
+# How many saves to batch between fsyncs. The energy state can be
+# reconstructed from last_power_w * dt, so losing a few cycles is tolerable.
+_FSYNC_EVERY = 10
+_SAVE_COUNT = 0
 
 def save_energy_state():
-    #Saves cumulative energy state to file
+    #Saves cumulative energy state to file (write-then-rename, so a crash
+    #mid-write never leaves a truncated file behind)
+    global _SAVE_COUNT, _LAST_SAVE_MONO
     try:
-        with open(ENERGY_FILE, 'w') as f:
-            json.dump(ENERGY_STATE, f)
+        tmp_file = ENERGY_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(ENERGY_STATE))
+            f.flush()
+            # Only pay the fsync cost on every Nth save
+            _SAVE_COUNT += 1
+            if _SAVE_COUNT % _FSYNC_EVERY == 0:
+                os.fsync(f.fileno())
+        os.replace(tmp_file, ENERGY_FILE)
+        # Record the save only once the rename landed, so a failed write
+        # is retried on the next cycle instead of being suppressed by the
+        # unsaved-delta threshold
+        ENERGY_STATE["last_saved_kwh"] = ENERGY_STATE["total_energy_kwh"]
+        _LAST_SAVE_MONO = time.monotonic()
     except Exception as e:
         logger.error(f"Failed to save energy state: {e}")
 
@@ -103,7 +176,11 @@ def initialize_mqtt_client():
 
     MQTT_CLIENT.on_connect = on_connect
     MQTT_CLIENT.on_disconnect = on_disconnect
-    
+
+    # Allow the client to stream a whole cycle's worth of publishes
+    # without head-of-line blocking on confirmations
+    MQTT_CLIENT.max_inflight_messages_set(20)
+
     # Attempt to connect and start the loop thread
     try:
         MQTT_CLIENT.connect(MQTT_BROKER, MQTT_PORT, 60)
@@ -138,8 +215,11 @@ def publish_discovery_config():
         'manufacturer': 'TechThom'
     }
 
-    logger.info("Publishing MQTT Discovery Config...")
-    
+    # Render every (topic, payload) pair first so the skip-hash below covers
+    # the actual published output - a change in how the payloads are built
+    # must invalidate the stored hash, not just a change to the dicts above
+    configs = []
+
     for key, props in SENSORS.items():
         # Sensor ID: e.g., ipmi_server1_total_power
         sensor_id = f"{BASE_CLIENT_ID}_{key.replace('/', '_')}"
@@ -147,14 +227,16 @@ def publish_discovery_config():
         # Discovery Topic: homeassistant/sensor/total_power/config
         discovery_topic = f"{HA_DISCOVERY_PREFIX}/sensor/{sensor_id}/config"
         
-        # State Topic: techthom/ipmi_server1/power/total/watts
-        state_topic = f"{BASE_TOPIC}/power/{key}"
-        
+        # All sensors share one aggregated JSON state topic and pick out
+        # their own reading with a value_template
+        state_topic = f"{BASE_TOPIC}/power/state"
+
         # Configuration Payload
         payload = {
             'name': f"{props['Name']}",
             'unique_id': sensor_id,
             'state_topic': state_topic,
+            'value_template': "{{ value_json['" + key + "'] }}",
             'unit_of_measurement': props.get('Unit', ''),
             'device': DEVICE_INFO,
             'icon': props.get('Icon', '')
@@ -168,22 +250,162 @@ def publish_discovery_config():
         elif 'Class' in props: # Default state class for instant measurements
             payload['state_class'] = 'measurement'
 
+        configs.append((discovery_topic, payload))
+
+    # Skip the 10 retained publishes entirely if the rendered configs are
+    # unchanged since the last publish (restart loops would flood the
+    # broker otherwise)
+    config_hash = hashlib.sha1(json.dumps(configs, sort_keys=True).encode()).hexdigest()
+    try:
+        with open(DISCOVERY_HASH_FILE, 'r') as f:
+            if f.read().strip() == config_hash:
+                logger.info("Discovery config unchanged. Skipping re-publish.")
+                return
+    except OSError:
+        pass # No hash file yet; publish and create it below
+
+    logger.info("Publishing MQTT Discovery Config...")
+
+    for discovery_topic, payload in configs:
         try:
-            MQTT_CLIENT.publish(discovery_topic, json.dumps(payload), retain=True)
-            logger.debug(f"Discovery published for: {props['Name']}")
+            MQTT_CLIENT.publish(discovery_topic, orjson.dumps(payload), qos=0, retain=True)
+            logger.debug(f"Discovery published for: {payload['name']}")
         except Exception as e:
-            logger.error(f"Error publishing discovery for {key}: {e}")
+            logger.error(f"Error publishing discovery for {payload['unique_id']}: {e}")
+
+    # Remember what was published so the next (re)connect can skip it
+    try:
+        with open(DISCOVERY_HASH_FILE, 'w') as f:
+            f.write(config_hash)
+    except OSError as e:
+        logger.error(f"Failed to write discovery hash file: {e}")
 
 # --- Data Parsing Functions ---
 
 def get_readings():
+    # Prefer the in-process pyghmi backend; spawning a JVM per poll costs
+    # hundreds of ms of startup alone. If the native path proves unable to
+    # deliver PSU readings, demote to the SMCIPMITool backend at runtime.
+    if _PYGHMI_USABLE:
+        readings = _get_readings_pyghmi()
+        if readings is not None:
+            return readings
+        if _PYGHMI_USABLE:
+            # Transient failure; retry the native path on the next poll
+            return None
+        logger.warning("Falling back to the SMCIPMITool backend.")
+    return _get_readings_smcipmitool()
+
+def _get_readings_pyghmi():
+    # Reads the PSU sensors over RMCP+ directly in-process
+    global _IPMI_CMD, _PYGHMI_USABLE, _PYGHMI_ERRORS
     try:
-        # Execute the SMCIPMITool command
-        command = SMCIPMI_CMD + SMCIPMI_PMINFO
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        if _IPMI_CMD is None:
+            _IPMI_CMD = ipmi_command.Command(bmc=IPMI_HOST, userid=IPMI_USER, password=IPMI_PASS)
+
+        readings = {}
+        total_watts = 0.0
+
+        for reading in _IPMI_CMD.get_sensor_data():
+            match = _IPMI_SENSOR_RE.match(reading.name or "")
+            if not match:
+                continue
+
+            module_num = match.group(1)
+            suffix, converter = _FIELD_MAP[match.group(2)]
+
+            if suffix == 'status':
+                # Status sensors carry discrete states instead of a value
+                value = ', '.join(reading.states) if reading.states else 'OK'
+            elif reading.value is None:
+                continue
+            else:
+                value = converter(reading.value)
 
-        # Regex to split output by module header
-        modules = re.split(r"\[Module\s*(\d+)\]", result.stdout)
+            readings[f'psu{module_num}/{suffix}'] = value
+            if suffix == 'watts':
+                total_watts += value
+
+        # Calculate and return results
+        if readings:
+            _PYGHMI_ERRORS = 0
+            readings['total/watts'] = total_watts
+            readings['total/kwh'] = calculate_energy(total_watts)
+            return readings
+
+        # The session works but no PSU sensors matched: this BMC does not
+        # expose the PSU input data over SDR, so the native backend will
+        # never work here
+        logger.error("Could not find any PSU sensors via IPMI.")
+        _PYGHMI_USABLE = False
+        return None
+
+    except Exception as e:
+        logger.error(f"IPMI sensor read failed: {e}")
+        # Drop the session so the next poll starts a fresh one; give up on
+        # the backend entirely after repeated consecutive failures
+        _IPMI_CMD = None
+        _PYGHMI_ERRORS += 1
+        if _PYGHMI_ERRORS >= _PYGHMI_MAX_ERRORS:
+            _PYGHMI_USABLE = False
+        return None
+
+def _read_until_prompt(proc):
+    # Reads shell output until the interactive prompt appears
+    output = []
+    tail = ''
+    while True:
+        char = proc.stdout.read(1)
+        if char == '':
+            raise EOFError("SMCIPMITool shell closed unexpectedly.")
+        output.append(char)
+        # Rolling tail avoids re-joining the whole buffer per character
+        tail = (tail + char)[-len(SMCIPMI_PROMPT):]
+        if tail == SMCIPMI_PROMPT:
+            return ''.join(output)
+
+def _start_smcipmi_shell():
+    # Starts SMCIPMITool in interactive shell mode and drains its banner
+    proc = subprocess.Popen(
+        SMCIPMI_CMD + SMCIPMI_SHELL,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, text=True, bufsize=1
+    )
+    try:
+        _read_until_prompt(proc)
+    except Exception:
+        # JVM died during the banner (bad credentials, unreachable BMC);
+        # reap it here instead of leaking the process until GC
+        proc.kill()
+        proc.wait()
+        raise
+    logger.info("Started persistent SMCIPMITool shell.")
+    return proc
+
+def _run_pminfo():
+    # Sends 'pminfo' to the persistent shell, restarting the JVM if it died
+    global _SMC_PROC
+    if _SMC_PROC is None or _SMC_PROC.poll() is not None:
+        if _SMC_PROC is not None:
+            logger.warning("SMCIPMITool shell exited. Restarting JVM...")
+        _SMC_PROC = _start_smcipmi_shell()
+    try:
+        _SMC_PROC.stdin.write("pminfo\n")
+        _SMC_PROC.stdin.flush()
+        return _read_until_prompt(_SMC_PROC)
+    except (OSError, EOFError):
+        # Drop the broken process; the next poll starts a fresh one
+        _SMC_PROC.kill()
+        _SMC_PROC = None
+        raise
+
+def _get_readings_smcipmitool():
+    try:
+        # Run 'pminfo' on the persistent SMCIPMITool shell
+        output = _run_pminfo()
+
+        # Split output by module header
+        modules = _MODULE_SPLIT.split(output)
 
         # Define Variables
         readings = {}
@@ -194,47 +416,32 @@ def get_readings():
             module_num = modules[i]
             module_content = modules[i+1]
             
-            # Simplified Regex: Finds "Input Power" in the module content and captures the value.
-            # Pattern: "name" + spaces + "|" + spaces + (Capture Group: number) + spaces + "symbol"
-            status_match = re.search(r"Status\s*\|\s*(\s*\S+)", module_content, re.MULTILINE)
-            voltage_match = re.search(r"Input Voltage\s*\|\s*(\s*\d+\.?\d*)\s*V", module_content, re.MULTILINE)
-            current_match = re.search(r"Input Current\s*\|\s*(\s*\d+\.?\d*)\s*A", module_content, re.MULTILINE)
-            power_match = re.search(r"Input Power\s*\|\s*(\s*\d+\.?\d*)\s*W", module_content, re.MULTILINE)
-
-            if status_match:
-                try:
-                    readings[f'psu{module_num}/status'] = str(status_match.group(1).strip())
-                except ValueError:
-                    # Ignore if the captured value isn't a valid string
-                    logger.warning(f"Failed to convert status value for PSU {module_num}.")
+            # The 'pminfo' lines are fixed-format ("Input Power | 123.4 W"),
+            # so a plain string walk is cheaper than the regex engine
+            for line in module_content.splitlines():
+                field_name, sep, rest = line.partition('|')
+                if not sep:
                     continue
-
-            if voltage_match:
-                try:
-                    readings[f'psu{module_num}/volt'] = float(voltage_match.group(1).strip())
-                except ValueError:
-                    # Ignore if the captured value isn't a valid number
-                    logger.warning(f"Failed to convert voltage value for PSU {module_num}.")
+                field_name = field_name.strip()
+                field = _FIELD_MAP.get(field_name)
+                if field is None:
                     continue
 
-            if current_match:
-                try:
-                    readings[f'psu{module_num}/amp'] = float(current_match.group(1).strip())
-                except ValueError:
-                    # Ignore if the captured value isn't a valid number
-                    logger.warning(f"Failed to convert amperé value for PSU {module_num}.")
+                suffix, converter = field
+                tokens = rest.split()
+                if not tokens:
                     continue
-
-            if power_match:
                 try:
-                    power = float(power_match.group(1).strip())
-                    readings[f'psu{module_num}/watts'] = power
-                    total_watts += power
+                    value = converter(tokens[0])
                 except ValueError:
                     # Ignore if the captured value isn't a valid number
-                    logger.warning(f"Failed to convert power value for PSU {module_num}.")
+                    logger.warning(f"Failed to convert {field_name} value for PSU {module_num}.")
                     continue
 
+                readings[f'psu{module_num}/{suffix}'] = value
+                if suffix == 'watts':
+                    total_watts += value
+
         # Calculate and return results
         if readings:
             readings['total/watts'] = total_watts
@@ -244,11 +451,11 @@ def get_readings():
         # Fallback if no readings were found
         logger.error("Could not parse any power values from 'pminfo' output.")
         logger.debug("--- First 5 lines of the SMCIPMITool output to check ---")
-        logger.debug('\n'.join(result.stdout.splitlines()[:5]))
+        logger.debug('\n'.join(output.splitlines()[:5]))
         return None
 
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error executing SMCIPMITool (Exit Code {e.returncode}): {e.stderr}")
+    except EOFError as e:
+        logger.error(f"SMCIPMITool shell failed: {e}")
         return None
     except FileNotFoundError:
         logger.critical("SMCIPMITool.jar or 'java' command not found.")
@@ -263,12 +470,13 @@ def calculate_energy(current_watts):
     # Calculates the energy consumed (kWh) since the last reading using the 
     # trapezoidal rule (averaging the current and previous power reading).
 
-    global ENERGY_STATE
-    
-    current_ts = time.time()
-    
-    # Time difference in hours
-    time_diff_hrs = (current_ts - ENERGY_STATE["last_update_ts"]) / 3600.0
+    global ENERGY_STATE, _LAST_MONOTONIC
+
+    current_mono = time.monotonic()
+
+    # Time difference in hours, measured on the monotonic clock so NTP
+    # step adjustments can't produce negative or huge deltas
+    time_diff_hrs = (current_mono - _LAST_MONOTONIC) / 3600.0
 
     # Average power during the interval (in Watts)
     avg_power_w = (current_watts + ENERGY_STATE["last_power_w"]) / 2.0
@@ -279,36 +487,53 @@ def calculate_energy(current_watts):
     # Convert to Kilowatt-hours (kWh)
     energy_kwh = energy_wh / 1000.0
 
-    # Update state
+    # Update state (last_update_ts stays on the wall clock as it is persisted)
     ENERGY_STATE["total_energy_kwh"] += energy_kwh
     ENERGY_STATE["last_power_w"] = current_watts
-    ENERGY_STATE["last_update_ts"] = current_ts
+    ENERGY_STATE["last_update_ts"] = time.time()
+    _LAST_MONOTONIC = current_mono
 
     logger.debug(f"Calculated energy: +{energy_kwh:.5f} kWh. New Total: {ENERGY_STATE['total_energy_kwh']:.3f} kWh")
-    save_energy_state()
-    
+
+    # Persist only once enough unsaved energy has accumulated or the last
+    # save has gone stale; writing every cycle amplifies wear on the
+    # container's data volume for no extra accuracy
+    unsaved_kwh = abs(ENERGY_STATE["total_energy_kwh"] - ENERGY_STATE["last_saved_kwh"])
+    if unsaved_kwh > _SAVE_MIN_DELTA_KWH or current_mono - _LAST_SAVE_MONO >= _SAVE_MAX_AGE_SEC:
+        save_energy_state()
+
     return ENERGY_STATE["total_energy_kwh"]
 
+# Last published readings (minus total/kwh, which strictly increases and
+# would defeat the comparison), for skipping cycles where nothing changed
+_LAST_PUBLISHED = None
+_CYCLES_SINCE_PUBLISH = 0
+# Force a publish at least this often so Home Assistant never marks the
+# sensors as unavailable on a long-stable server
+_FORCE_PUBLISH_CYCLES = 10
+
 def publish_to_mqtt(topic: str, value):
-    # Uses the global client to publish sensor data
+    # Uses the global client to enqueue sensor data for publishing.
+    # Does not block on delivery confirmation; the caller may wait on the
+    # returned MQTTMessageInfo if it needs to.
     try:
-        # Publish the state value as a string
-        result = MQTT_CLIENT.publish(topic, str(value), retain=False)
-        result.wait_for_publish()
+        # Publish the state value as-is for pre-encoded bytes, else as a string
+        payload = value if isinstance(value, bytes) else str(value)
+        result = MQTT_CLIENT.publish(topic, payload, qos=0, retain=False)
         logger.debug(f"Published: {value} to topic: {topic}")
-        return True
-        
+        return result
+
     except Exception as e:
         logger.error(f"Error publishing to MQTT topic {topic}: {e}")
-        return False
+        return None
         
 # --- Main Execution ---
 
 if __name__ == "__main__":
     logger.info("Start SMCIPMITool to MQTT service with HA Discovery...")
     
-    if not os.path.exists("/usr/local/bin/SMCIPMITool.jar"):
-        logger.critical("FATAL ERROR: SMCIPMITool.jar not found.")
+    if ipmi_command is None and not os.path.exists("/usr/local/bin/SMCIPMITool.jar"):
+        logger.critical("FATAL ERROR: pyghmi not installed and SMCIPMITool.jar not found.")
         exit(1)
 
     # Load any persistent energy state
@@ -317,17 +542,49 @@ if __name__ == "__main__":
     # Initialize the persistent client connection
     initialize_mqtt_client()
 
-    # Start the main polling loop
+    # Start the main polling loop. Sleeping against an absolute deadline
+    # keeps the sample period at INTERVAL instead of INTERVAL + work time,
+    # which would otherwise skew the kWh integration.
+    next_tick = time.monotonic()
+
+    # The IPMI poll dominates each cycle, so it runs in a worker thread
+    # while this thread publishes the previous cycle's readings - the BMC
+    # round-trip and the MQTT I/O overlap instead of running back-to-back.
+    ipmi_executor = ThreadPoolExecutor(max_workers=1)
+    data = None
+
     while True:
-        data = get_readings()
-        
-        # Publish readings
+        poll_future = ipmi_executor.submit(get_readings)
+
+        # Publish the previous cycle's readings while the poll runs
         if MQTT_CLIENT is None or not MQTT_CLIENT.is_connected():
             logger.warning("MQTT client is not connected. Skipping publication.")
         else:
             if data:
-                for key, value in data.items():
-                    full_topic = f"{BASE_TOPIC}/power/{key}"
-                    publish_to_mqtt(full_topic, value)
-       
-        time.sleep(INTERVAL)
\ No newline at end of file
+                _CYCLES_SINCE_PUBLISH += 1
+                # Compare without total/kwh: the counter advances whenever
+                # any power is drawn, so including it would make every
+                # cycle look changed. Energy updates ride along with the
+                # next changed reading or the forced publish cadence.
+                comparable = {k: v for k, v in data.items() if k != 'total/kwh'}
+                if comparable != _LAST_PUBLISHED or _CYCLES_SINCE_PUBLISH >= _FORCE_PUBLISH_CYCLES:
+                    # Publish all readings as one JSON payload instead of
+                    # ~10 individual messages per cycle. Fire-and-forget: at
+                    # QoS 0 wait_for_publish() returns immediately anyway but
+                    # still takes the client's internal lock.
+                    publish_to_mqtt(f"{BASE_TOPIC}/power/state", orjson.dumps(data))
+                    _LAST_PUBLISHED = comparable
+                    _CYCLES_SINCE_PUBLISH = 0
+                else:
+                    logger.debug("Readings unchanged. Skipping publish this cycle.")
+
+        data = poll_future.result()
+
+        next_tick += INTERVAL
+        sleep_s = next_tick - time.monotonic()
+        if sleep_s > 0:
+            time.sleep(sleep_s)
+        else:
+            # Fell behind (e.g. a slow poll); resynchronize rather than
+            # bursting to catch up
+            next_tick = time.monotonic()
\ No newline at end of file